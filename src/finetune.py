@@ -79,6 +79,16 @@ def init_parser() -> argparse.ArgumentParser:
         default=5,
         help="Batch size for training and evaluation",
     )
+    parser.add_argument(
+        "--grad_accum_steps",
+        type=int,
+        default=1,
+        help=(
+            "Number of train steps to accumulate gradients over before each "
+            "optimizer update; micro-batches are sized "
+            "batch_size // grad_accum_steps"
+        ),
+    )
     parser.add_argument(
         "--patience",
         type=int,
@@ -139,6 +149,8 @@ def init_parser() -> argparse.ArgumentParser:
 
 
 def main() -> None:
+    # grow allocator segments instead of re-cudaMalloc'ing on fragmentation
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
     args = init_parser().parse_args()
     dist_utils.init_distributed([logger, trainer.logger])
     text_tokenizer: NllbTokenizer = load_unity_text_tokenizer(args.model_name)
@@ -150,6 +162,7 @@ def main() -> None:
         float_dtype=torch.float16 if torch.device(args.device).type != "cpu" else torch.bfloat16,
         train_batch_size=args.batch_size,
         eval_batch_size=args.batch_size,
+        grad_accum_steps=args.grad_accum_steps,
         patience=args.patience,
         max_epochs=args.max_epochs,
         learning_rate=args.learning_rate,
@@ -188,7 +201,9 @@ def main() -> None:
         text_tokenizer=text_tokenizer,
         unit_tokenizer=unit_tokenizer,
         batching_config=dataloader.BatchingConfig(
-            batch_size=finetune_params.train_batch_size,
+            batch_size=max(
+                1, finetune_params.train_batch_size // finetune_params.grad_accum_steps
+            ),
             rank=dist_utils.get_rank(),
             world_size=dist_utils.get_world_size(),
             max_audio_length_sec=15.0,
@@ -208,6 +223,10 @@ def main() -> None:
         ),
         dataset_manifest_path=args.eval_dataset,
     )
+    # build tokenizer encoders before dataloader workers fork so they
+    # inherit the tables instead of each reloading them
+    train_dataloader.warmup()
+    eval_dataloader.warmup()
     finetune = trainer.UnitYFinetune(
         model=model,
         params=finetune_params,
@@ -215,7 +234,6 @@ def main() -> None:
         eval_data_loader=eval_dataloader,
     )
     del args, finetune_params, train_dataloader, eval_dataloader, text_tokenizer, unit_tokenizer, model
-    torch.cuda.empty_cache()
 
     finetune.run()
 
@@ -5,22 +5,27 @@
 # MIT_LICENSE file in the root directory of this source tree.
 
 
-import json
+import functools
 import logging
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
 import torchaudio
-from datasets import Dataset
+from datasets import Dataset, load_dataset
 from datasets.distributed import split_dataset_by_node
 from fairseq2.data.text import TextTokenEncoder
 from fairseq2.models.nllb import NllbTokenizer
 from fairseq2.data.audio import WaveformToFbankConverter
+from fairseq2.typing import Device
 from torch import Tensor
 from torch.nn.functional import pad as pad_tensor
-from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Sampler
 
 from seamless_communication.datasets.datatypes import LangPairSample
 from seamless_communication.models.unity.unit_tokenizer import (
@@ -39,18 +44,14 @@ class SeqsBatch:
     prev_output_tokens: Optional[Tensor]
     target_lengths: Optional[Tensor]
 
-    def __del__(self) -> None:
-        """Explicitly delete tensors
-        to force GPU memory cleanup"""
-        for tensor in [
-            self.src_tokens,
-            self.src_lengths,
-            self.target_tokens,
-            self.prev_output_tokens,
-            self.target_lengths,
-        ]:
-            if tensor is not None:
-                del tensor
+    def pin_memory(self) -> "SeqsBatch":
+        """Called by the DataLoader's pin thread when pin_memory is enabled"""
+        return SeqsBatch(
+            **{
+                field: tensor.pin_memory() if tensor is not None else None
+                for field, tensor in vars(self).items()
+            }
+        )
 
 
 @dataclass
@@ -58,9 +59,11 @@ class MultimodalSeqsBatch:
     speech_to_text: SeqsBatch
     text_to_units: SeqsBatch
 
-    def __del__(self) -> None:
-        del self.speech_to_text
-        del self.text_to_units
+    def pin_memory(self) -> "MultimodalSeqsBatch":
+        return MultimodalSeqsBatch(
+            speech_to_text=self.speech_to_text.pin_memory(),
+            text_to_units=self.text_to_units.pin_memory(),
+        )
 
 
 @dataclass
@@ -83,6 +86,9 @@ class BatchingConfig:
     num_workers: int = 2
     """Parallelism in dataset preparation."""
 
+    pin_memory: bool = True
+    """Allocate batches in pinned memory to allow async host-to-device copies."""
+
     float_dtype: torch.dtype = torch.float16
     """Select between fp16/fp32 for float tensors """
 
@@ -91,6 +97,122 @@ def worker_init_fn(worker_id: int) -> None:
     np.random.seed(np.random.get_state()[1][0] + worker_id)  # type: ignore
 
 
+def _add_duration_column(sample: Dict[str, Any]) -> Dict[str, float]:
+    """Read audio duration from the file header without decoding samples."""
+    info = torchaudio.info(sample["source"]["audio_local_path"])
+    return {"_dur": info.num_frames / info.sample_rate}
+
+
+@functools.lru_cache(maxsize=4)
+def _make_fbank_converter(
+        num_mel_bins: int,
+        waveform_scale: int,
+        channel_last: bool,
+        standardize: bool,
+        device: Device,
+        dtype: torch.dtype,
+) -> WaveformToFbankConverter:
+    """Cached per parameter set so window/mel tables are built only once
+    per process, even when several loaders share the same config."""
+    return WaveformToFbankConverter(
+        num_mel_bins=num_mel_bins,
+        waveform_scale=waveform_scale,
+        channel_last=channel_last,
+        standardize=standardize,
+        device=device,
+        dtype=dtype,
+    )
+
+
+class LengthBucketedSampler(Sampler[List[int]]):
+    """Yields batches of indices with similar audio duration so that padding
+    to the longest sample in a batch wastes less compute."""
+
+    def __init__(
+            self,
+            durations: List[float],
+            batch_size: int,
+            num_buckets: int = 32,
+    ):
+        self.batch_size = batch_size
+        order = sorted(range(len(durations)), key=lambda idx: durations[idx])
+        bucket_size = max(1, math.ceil(len(order) / num_buckets))
+        self.buckets = [
+            order[start: start + bucket_size]
+            for start in range(0, len(order), bucket_size)
+        ]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = []
+        for bucket in self.buckets:
+            bucket = bucket.copy()
+            random.shuffle(bucket)
+            for start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[start: start + self.batch_size])
+        random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return sum(
+            math.ceil(len(bucket) / self.batch_size) for bucket in self.buckets
+        )
+
+
+class CUDAPrefetcher:
+    """Copies batches to a CUDA device on a side stream so that the
+    host-to-device transfer of the next batch overlaps with compute
+    on the current one."""
+
+    def __init__(self, loader: Iterable[Optional[MultimodalSeqsBatch]], device: Device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self._iterator: Optional[Iterator[Optional[MultimodalSeqsBatch]]] = None
+        self._next_batch: Optional[MultimodalSeqsBatch] = None
+
+    def _move_seqs(self, seqs: SeqsBatch) -> SeqsBatch:
+        return SeqsBatch(
+            **{
+                field: tensor.to(self.device, non_blocking=True)
+                if tensor is not None
+                else None
+                for field, tensor in vars(seqs).items()
+            }
+        )
+
+    def _preload(self) -> None:
+        assert self._iterator is not None
+        try:
+            batch = next(self._iterator)
+            while batch is None:  # batches that were fully filtered out
+                batch = next(self._iterator)
+        except StopIteration:
+            self._next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self._next_batch = MultimodalSeqsBatch(
+                speech_to_text=self._move_seqs(batch.speech_to_text),
+                text_to_units=self._move_seqs(batch.text_to_units),
+            )
+
+    def __iter__(self) -> Iterator[MultimodalSeqsBatch]:
+        self._iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def __next__(self) -> MultimodalSeqsBatch:
+        if self._next_batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self._next_batch
+        for seqs in (batch.speech_to_text, batch.text_to_units):
+            for tensor in vars(seqs).values():
+                if tensor is not None:
+                    tensor.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return batch
+
+
 class UnitYDataLoader:
     SAMPLE_RATE = 16_000
 
@@ -112,33 +234,73 @@ class UnitYDataLoader:
             "channel_last": True,
             "standardize": True,
             "device": torch.device("cpu"),
-            "dtype": self.batching_config.float_dtype,
+            # extract in fp32 to avoid overflow/NaN in the log-mel ops;
+            # batching casts to `float_dtype` once afterwards
+            "dtype": torch.float32,
         }
+        self._fbank_converter = _make_fbank_converter(
+            **self._fbank_extract_params  # type: ignore
+        )
+        # tokenization results keyed by sample index, filled on first epoch
+        self._text_cache: Dict[int, Tensor] = {}
+        self._unit_cache: Dict[int, Optional[Tensor]] = {}
+        # created lazily (per worker) so the loader stays picklable
+        self._pool: Optional[ThreadPoolExecutor] = None
         self.dataset = self._load_manifest(dataset_manifest_path)
 
+    def warmup(self, languages: Optional[List[str]] = None) -> None:
+        """Pre-build per-language tokenizer encoders in the main process so
+        forked dataloader workers inherit them via copy-on-write memory
+        instead of each paying the SentencePiece load on its first batch."""
+        if languages is None:
+            # project only the language field; materializing the full target
+            # column would pull every unit-token list into driver memory
+            languages = sorted(self.dataset.flatten().unique("target.lang"))
+        for lang in languages:
+            if lang not in self.text_encoders_per_lang:
+                self.text_encoders_per_lang[
+                    lang
+                ] = self.text_tokenizer.create_encoder(lang=lang, mode="target")
+            if lang not in self.unit_encoders_per_lang:
+                self.unit_encoders_per_lang[
+                    lang
+                ] = self.unit_tokenizer.create_encoder(lang=lang)
+        logger.info(f"Warmed up tokenizer encoders for languages: {languages}")
+
     def get_dataloader(self) -> DataLoader[SeqsBatch]:
         subset = split_dataset_by_node(
             self.dataset,
             rank=self.batching_config.rank,
             world_size=self.batching_config.world_size,
         )
+        durations = subset["_dur"]
+        batch_sampler = LengthBucketedSampler(
+            durations=durations, batch_size=self.batching_config.batch_size
+        )
+        num_workers = self.batching_config.num_workers
         data_loader = DataLoader(
             dataset=subset,
-            batch_size=self.batching_config.batch_size,
-            shuffle=True,
-            num_workers=self.batching_config.num_workers,
+            batch_sampler=batch_sampler,
+            num_workers=num_workers,
             collate_fn=self._prepare_batch,
             worker_init_fn=worker_init_fn,
+            pin_memory=self.batching_config.pin_memory,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
         )
         del subset
 
         return data_loader
 
-    def __iter__(self) -> Iterable[MultimodalSeqsBatch]:
+    def __iter__(self) -> Iterator[Optional[MultimodalSeqsBatch]]:
         return self.get_dataloader().__iter__()
 
-    def _get_source_fbank(self, sample: LangPairSample) -> Tensor:
-        wav, sample_rate = torchaudio.load(sample.source.audio_local_path)
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_pool"] = None  # thread pools cannot be pickled
+        return state
+
+    def _fbank_from_wav(self, wav: Tensor, sample_rate: int) -> Tensor:
         assert (
                 int(sample_rate) == self.SAMPLE_RATE
         ), f"sample != {self.SAMPLE_RATE}, please resample"
@@ -147,15 +309,22 @@ class UnitYDataLoader:
             wav = wav.unsqueeze(-1)
         elif wav.shape[0] <= 2:  # channel is first, should be second
             wav = wav.transpose(0, 1)
-        return WaveformToFbankConverter(**self._fbank_extract_params)(  # type: ignore
+        return self._fbank_converter(
             {
                 "waveform": wav,
                 "sample_rate": self.SAMPLE_RATE,
             }
         )["fbank"]
 
-    def _get_tokenized_target_text(self, sample: LangPairSample) -> Tensor:
+    def _get_source_fbank(self, sample: LangPairSample) -> Tensor:
+        wav, sample_rate = torchaudio.load(sample.source.audio_local_path)
+        return self._fbank_from_wav(wav, sample_rate)
+
+    def _get_tokenized_target_text(self, idx: int, sample: LangPairSample) -> Tensor:
         """Expected sequence is [<eos>, <lang_tok> , ..text tokens.., <eos>]"""
+        cached = self._text_cache.get(idx)
+        if cached is not None:
+            return cached
         target_lang = sample.target.lang
         if target_lang not in self.text_encoders_per_lang:
             self.text_encoders_per_lang[
@@ -163,12 +332,16 @@ class UnitYDataLoader:
             ] = self.text_tokenizer.create_encoder(lang=target_lang, mode="target")
         tokens = self.text_encoders_per_lang[target_lang](sample.target.text)
         eos_idx = self.text_tokenizer.vocab_info.eos_idx
-        tokens = torch.concat([tokens, torch.LongTensor([eos_idx])])
+        tokens = pad_tensor(tokens, (0, 1), value=eos_idx)
+        self._text_cache[idx] = tokens
         return tokens
 
-    def _get_tokenized_units(self, sample: LangPairSample) -> Optional[Tensor]:
+    def _get_tokenized_units(self, idx: int, sample: LangPairSample) -> Optional[Tensor]:
         """Expected sequence is [<eos>, <lang_tok> , ..unit tokens.., <eos>]"""
+        if idx in self._unit_cache:
+            return self._unit_cache[idx]
         if sample.target.units is None:
+            self._unit_cache[idx] = None
             return None
         target_lang = sample.target.lang
         if target_lang not in self.unit_encoders_per_lang:
@@ -179,49 +352,82 @@ class UnitYDataLoader:
             torch.LongTensor(sample.target.units).unsqueeze(0)
         )
         eos_idx = self.unit_tokenizer.vocab_info.eos_idx
-        tokens = torch.concat([tokens.squeeze(0), torch.LongTensor([eos_idx])])
+        tokens = pad_tensor(tokens.squeeze(0), (0, 1), value=eos_idx)
+        self._unit_cache[idx] = tokens
         return tokens
 
-    def _batch_tensors(self, tensors: List[Tensor], pad_value: Any) -> Tensor:
+    def _batch_tensors(
+            self,
+            tensors: List[Tensor],
+            pad_value: Any,
+            dtype: Optional[torch.dtype] = None,
+    ) -> Tensor:
+        if dtype is None:
+            return pad_sequence(tensors, batch_first=True, padding_value=pad_value)
+        # preallocate in the target dtype so copy_ fuses the cast into the
+        # single padding pass
         padding_size = max(tensor.shape[0] for tensor in tensors)
-        dims = len(tensors[0].shape)
-        padded_tensors = []
-        for tensor in tensors:
-            padding = [0] * 2 * dims
-            padding[-1] = padding_size - tensor.shape[0]
-            padded_tensors.append(pad_tensor(tensor, padding, "constant", pad_value))
-        del padding_size
-        return torch.stack([tensor for tensor in padded_tensors], dim=0)
-
-    def _is_long_src_audio(self, sample: LangPairSample) -> bool:
-        wav, sample_rate = torchaudio.load(sample.source.audio_local_path)
-        length_s: float = max(wav.shape) / sample_rate
-        return length_s > self.batching_config.max_audio_length_sec
+        batched = torch.full(
+            (len(tensors), padding_size) + tensors[0].shape[1:],
+            pad_value,
+            dtype=dtype,
+        )
+        for idx, tensor in enumerate(tensors):
+            batched[idx, : tensor.shape[0]].copy_(tensor)
+        return batched
 
-    def _prepare_batch(self, raw_samples: List[Dict[str, Any]]) -> MultimodalSeqsBatch:
-        samples = [LangPairSample.from_json(sample) for sample in raw_samples]
+    def _prepare_batch(
+            self, raw_samples: List[Dict[str, Any]]
+    ) -> Optional[MultimodalSeqsBatch]:
         # input speech
-        #  - filter long audio samples
-        filtered_samples = [sample for sample in samples if not self._is_long_src_audio(sample)]
-        samples = filtered_samples if filtered_samples else [samples[0]]  # keep at least one sample
-        src_tokens_list = [self._get_source_fbank(sample) for sample in samples]
-        #  - filter NaNs in fbanks
-        with_nans = [fbank.isnan().any().item() for fbank in src_tokens_list]
-        samples = [sample for sample, skip in zip(samples, with_nans) if not skip]
-        assert len(samples) > 0
-        src_tokens_list = [
-            src_toks for src_toks, skip in zip(src_tokens_list, with_nans) if not skip
+        #  - filter long audio samples before building dataclasses
+        #    (durations were precomputed at manifest load)
+        filtered_raw = [
+            raw
+            for raw in raw_samples
+            if raw["_dur"] <= self.batching_config.max_audio_length_sec
         ]
+        if not filtered_raw:
+            return None  # training loop skips empty batches
+        samples = [
+            (int(sample["_idx"]), LangPairSample.from_json(sample))
+            for sample in filtered_raw
+        ]
+        # torchaudio.load and the fbank kernel both release the GIL, so
+        # extracting fbanks concurrently overlaps disk I/O with compute
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=4)
+        fbanks = list(
+            self._pool.map(self._get_source_fbank, [sample for _, sample in samples])
+        )
+        #  - filter NaNs in fbanks and collect lengths in the same pass
+        kept_samples: List[Tuple[int, LangPairSample]] = []
+        src_tokens_list: List[Tensor] = []
+        src_lens: List[int] = []
+        for (idx, sample), fbank in zip(samples, fbanks):
+            if bool(torch.isnan(fbank).any()):
+                continue
+            kept_samples.append((idx, sample))
+            src_tokens_list.append(fbank)
+            src_lens.append(fbank.shape[0])
+        samples = kept_samples
+        if not samples:
+            logger.warning("All samples in the batch had NaN fbanks, skipping it")
+            return None
         src_tokens = self._batch_tensors(
-            src_tokens_list, pad_value=self.batching_config.fbank_feats_pad_idx
-        ).to(self.batching_config.float_dtype)
-        src_lengths = torch.LongTensor(
-            [src_tokens.shape[0] for src_tokens in src_tokens_list]
+            src_tokens_list,
+            pad_value=self.batching_config.fbank_feats_pad_idx,
+            dtype=self.batching_config.float_dtype,
         )
+        src_lengths = torch.tensor(src_lens, dtype=torch.long)
         # output text
         text_tokens_list = [
-            self._get_tokenized_target_text(sample) for sample in samples
+            self._get_tokenized_target_text(idx, sample) for idx, sample in samples
         ]
+        # capture lengths before padding
+        tokens_lengths = torch.tensor(
+            [tokens.shape[0] - 1 for tokens in text_tokens_list], dtype=torch.long
+        )
         text_pad_idx = self.text_tokenizer.vocab_info.pad_idx
         prev_outputs_tokens = self._batch_tensors(
             [tokens[:-1] for tokens in text_tokens_list], pad_value=text_pad_idx
@@ -229,12 +435,11 @@ class UnitYDataLoader:
         target_tokens = self._batch_tensors(
             [tokens[1:] for tokens in text_tokens_list], pad_value=text_pad_idx
         )
-        tokens_lengths = torch.LongTensor(
-            [tokens.shape[0] - 1 for tokens in text_tokens_list]
-        )
         # output units
-        units_list_raw = [self._get_tokenized_units(sample) for sample in samples]
-        del samples, filtered_samples, src_tokens_list, with_nans
+        units_list_raw = [
+            self._get_tokenized_units(idx, sample) for idx, sample in samples
+        ]
+        del samples, filtered_raw, kept_samples, fbanks, src_tokens_list
 
         if None in units_list_raw:
             prev_outputs_units = None
@@ -244,6 +449,10 @@ class UnitYDataLoader:
             units_list: List[Tensor] = [
                 value for value in units_list_raw if value is not None
             ]
+            # capture lengths before padding
+            units_lengths = torch.tensor(
+                [tokens.shape[0] - 1 for tokens in units_list], dtype=torch.long
+            )
             units_pad_idx = self.unit_tokenizer.vocab_info.pad_idx
             prev_outputs_units = self._batch_tensors(
                 [tokens[:-1] for tokens in units_list], pad_value=units_pad_idx
@@ -251,9 +460,6 @@ class UnitYDataLoader:
             target_units = self._batch_tensors(
                 [tokens[1:] for tokens in units_list], pad_value=units_pad_idx
             )
-            units_lengths = torch.LongTensor(
-                [tokens.shape[0] - 1 for tokens in units_list]
-            )
             del units_list
         del units_list_raw
         return MultimodalSeqsBatch(
@@ -274,6 +480,17 @@ class UnitYDataLoader:
         )
 
     def _load_manifest(self, dataset_manifest_path: str) -> Dataset:
-        with open(dataset_manifest_path) as fp_in:
-            dataset = [json.loads(line) for line in fp_in]
-            return Dataset.from_list(dataset)
+        # memory-maps the Arrow cache instead of materializing all rows in RAM
+        dataset = load_dataset(
+            "json", data_files=str(dataset_manifest_path), split="train"
+        )
+        # probe durations once so bucketing and filtering become O(1) lookups
+        dataset = dataset.map(
+            _add_duration_column, num_proc=min(8, len(dataset)) or None
+        )
+        max_audio_length_sec = self.batching_config.max_audio_length_sec
+        dataset = dataset.filter(
+            lambda sample: sample["_dur"] <= max_audio_length_sec
+        )
+        # sample index keys the tokenization caches in _prepare_batch
+        return dataset.add_column("_idx", list(range(len(dataset))))
@@ -11,7 +11,7 @@ from dataclasses import dataclass
 from enum import Enum
 from tqdm import tqdm
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Iterable, Optional, Tuple
 from torch import Tensor
 
 import torch
@@ -76,6 +76,10 @@ class FinetuneParams:
     train_batch_size: int = 2
     """The batch size during train steps"""
 
+    grad_accum_steps: int = 1
+    """Number of train steps to accumulate gradients over
+    before each optimizer update"""
+
     eval_batch_size: int = 2
     """The batch size during evaluation."""
 
@@ -359,6 +363,14 @@ class UnitYFinetune:
             del wrapped_model, find_unused
             torch.cuda.empty_cache()
 
+    def _wrap_data_loader(
+            self, data_loader: Iterable[dataloader.MultimodalSeqsBatch]
+    ) -> Iterable[dataloader.MultimodalSeqsBatch]:
+        """Overlap host-to-device batch copies with compute on CUDA devices"""
+        if self.params.device.type == "cuda":
+            return dataloader.CUDAPrefetcher(data_loader, self.params.device)
+        return data_loader
+
     def _update_eval_stats(self, eval_loss: float) -> None:
         self.is_best_state = (
                 self.best_eval_loss is None or eval_loss < self.best_eval_loss
@@ -382,7 +394,11 @@ class UnitYFinetune:
         loss_hist = LossCollector(device=self.params.device)
         self.model.eval()
         with torch.no_grad():
-            for batch in tqdm(self.eval_data_loader.get_dataloader()):
+            for batch in tqdm(
+                self._wrap_data_loader(self.eval_data_loader.get_dataloader())
+            ):
+                if batch is None:  # all samples were filtered out
+                    continue
                 assert batch.speech_to_text.src_tokens is not None
                 with torch.autocast(device_type=self.params.device.type, dtype=self.params.float_dtype):
                     loss = self.calc_loss(batch, *self.model(batch))
@@ -397,10 +413,15 @@ class UnitYFinetune:
                 del batch  # force memory release
             torch.cuda.empty_cache()
 
+        # _collect() runs on every rank, keeping the collective symmetric
+        if loss_hist._collect()[0] == 0:
+            print("Warning - No eval batches survived filtering, skipping eval")
+            del loss_hist
+            return
         eval_loss = loss_hist.reduce()
         self._update_eval_stats(eval_loss)
 
-        del loss_hist, loss, eval_loss, loss_val
+        del loss_hist, eval_loss
         torch.cuda.empty_cache()
 
     def _train_step_log(self) -> None:
@@ -420,17 +441,20 @@ class UnitYFinetune:
     def _train_step(self, batch: dataloader.MultimodalSeqsBatch) -> None:
         """Run one train step"""
         self.model.train()
-        self.optimizer.zero_grad()
+        grad_accum_steps = self.params.grad_accum_steps
+        if self.update_idx % grad_accum_steps == 0:
+            self.optimizer.zero_grad()
         with torch.autocast(device_type=self.params.device.type, dtype=self.params.float_dtype):
             tokens, units = self.model(batch)
         loss = self.calc_loss(batch, tokens, units)
         if loss.isnan().any().item():
             print('Error : ', batch.speech_to_text)
             raise RuntimeError("Loss is Nan. Terminating.")
-        self.grad_scaler.scale(loss).backward()
-        self.grad_scaler.step(self.optimizer)
-        self.grad_scaler.update()
-        self.lr_scheduler.step()
+        self.grad_scaler.scale(loss / grad_accum_steps).backward()
+        if (self.update_idx + 1) % grad_accum_steps == 0:
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+            self.lr_scheduler.step()
         assert batch.speech_to_text.src_tokens is not None
         self.train_loss_hist.update(1, loss.item())
         self._train_step_log()
@@ -464,9 +488,11 @@ class UnitYFinetune:
         print("Start finetuning")
         self._reset_stats()
         self._eval_model()
-        batch_itr = self.train_data_loader.get_dataloader()
+        batch_itr = self._wrap_data_loader(self.train_data_loader.get_dataloader())
         while self.epoch_idx < self.params.max_epochs and self.patience_left:
             for train_batch in batch_itr:
+                if train_batch is None:  # all samples were filtered out
+                    continue
                 self._train_step(batch=train_batch)
                 if self.update_idx and self.update_idx % self.params.eval_steps == 0:
                     self._eval_model()